@@ -43,3 +43,19 @@ def print_analysis(pv, demand, param, E):
     print ('Total battery losses: {:.3g} kWh'.format(BatteryLosses))
     print ('Total inverter losses: {:.3g} kWh'.format(InverterLosses))
     print ('Residue (check): {:.3g} kWh'.format(residue))
+
+
+def fleet_percentiles(X, percentiles=(5, 25, 50, 75, 95)):
+    """ Percentiles across households of a batch of time series, computed in a single vectorized call
+
+    Arguments
+        X (ndarray or pd.DataFrame): array of shape (Nsteps, Nhouseholds)
+        percentiles (sequence): percentiles to compute, between 0 and 100
+    Returns
+        ndarray: array of shape (Nsteps, len(percentiles))
+
+    """
+    X = np.asarray(X, dtype=float)
+    if X.ndim == 1:
+        X = X[:, None]
+    return np.percentile(X, percentiles, axis=1).T
@@ -1,50 +1,225 @@
 """Plotting functions"""
+import weakref
+
+import numpy as np
+import pandas as pd
 import matplotlib.pyplot as plt
 
-def plot_dispatch(pv, demand, E, week=30):
-    """ Visualize dispatch algorithm for a specific week
+from .analysis import fleet_percentiles
+
+__all__ = ['plot_dispatch', 'plot_fleet', 'downsample']
+
+
+# ISO week numbers, memoised per index object so that plotting several weeks of the same series
+# does not rebuild the calendar. Entries are dropped when the index is garbage collected.
+_ISO_WEEKS = {}
+
+
+def _iso_weeks(index):
+    """ Return the ISO week number of each timestep of a DatetimeIndex (computed once per index object) """
+    key = id(index)
+    cached = _ISO_WEEKS.get(key)
+    if cached is not None and cached[0]() is index:
+        return cached[1]
+    weeks = np.asarray(index.isocalendar().week)
+    _ISO_WEEKS[key] = (weakref.ref(index, lambda _, key=key: _ISO_WEEKS.pop(key, None)), weeks)
+    return weeks
+
+
+def _select_period(index, week=None, start=None, end=None):
+    """ Return an indexer (slice or integer positions) selecting the requested period of a DatetimeIndex.
+    A date range (start/end) takes precedence over the ISO week number. Bounds are inclusive and partial
+    dates are resolved as in pandas label slicing (e.g. end='2015-01-02' includes the whole day).
+    """
+    if start is not None or end is not None:
+        if index.is_monotonic_increasing:
+            return index.slice_indexer(start, end)
+        # Apply the same slicing rule on a sorted copy and map back to the original positions
+        order = index.argsort()
+        return np.sort(order[index[order].slice_indexer(start, end)])
+    if week is not None:
+        return np.flatnonzero(_iso_weeks(index) == week)
+    return slice(None)
+
+
+def _minmax_indices(values, n_out):
+    """ Positions of the minimum and maximum of each column within n_out/2 equal buckets shared by all columns.
+    The union over all columns is returned so that every series keeps its envelope at full resolution and
+    stacked flows stay consistent with each other (all series are sampled at the same timesteps).
+    """
+    n = values.shape[0]
+    n_buckets = max(n_out // 2, 1)
+    edges = np.linspace(0, n, n_buckets + 1).astype(int)
+    width = np.diff(edges).max()
+    # Pad each bucket to the same width so that argmin/argmax run on a single 3D array
+    pos = edges[:-1, None] + np.arange(width)[None, :]
+    valid = pos < edges[1:, None]
+    pos = np.minimum(pos, n - 1)
+    buckets = values[pos]                               # (n_buckets, width, n_cols)
+    # NaNs are ignored; a bucket that only holds NaNs falls back on its first (NaN) element so the gap is still drawn
+    keep = valid[:, :, None] & ~np.isnan(buckets)
+    lo = np.where(keep, buckets, np.inf).argmin(axis=1)
+    hi = np.where(keep, buckets, -np.inf).argmax(axis=1)
+    rows = np.arange(n_buckets)[:, None]
+    idx = np.concatenate([pos[rows, lo].ravel(), pos[rows, hi].ravel(), [0, n - 1]])
+    return np.unique(idx)
+
+
+def _lttb_indices(y, n_out):
+    """ Largest-Triangle-Three-Buckets selection of n_out positions of the 1D array y.
+    NaNs are skipped; a bucket that only holds NaNs is represented by one of them so the gap is still drawn.
+    """
+    n = len(y)
+    x = np.arange(n, dtype=float)
+    finite = ~np.isnan(y)
+    edges = np.linspace(1, n - 1, n_out - 1).astype(int)
+    idx = np.empty(n_out, dtype=int)
+    idx[0], idx[-1] = 0, n - 1
+    a = 0
+    for i in range(n_out - 2):
+        lo, hi = edges[i], edges[i + 1]
+        nxt_lo, nxt_hi = edges[i + 1], edges[i + 2] if i + 2 < len(edges) else n
+        nxt = finite[nxt_lo:nxt_hi]
+        if nxt.any():
+            x_avg, y_avg = x[nxt_lo:nxt_hi][nxt].mean(), y[nxt_lo:nxt_hi][nxt].mean()
+        else:
+            x_avg, y_avg = x[a], y[a]
+        if np.isnan(y[a]):
+            # No valid anchor yet (leading gap): use the next bucket average as both triangle ends
+            area = np.abs(y[lo:hi] - y_avg)
+        else:
+            area = np.abs((x[a] - x_avg) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (y_avg - y[a]))
+        area = np.where(finite[lo:hi], np.nan_to_num(area, nan=0.), -np.inf)
+        k = lo + int(area.argmax())
+        idx[i + 1] = k
+        if finite[k]:
+            a = k
+    return idx
+
+
+def downsample(df, max_points, method='minmax'):
+    """ Decimate a DataFrame of time series before plotting so that each column keeps about max_points points.
+    All columns are sampled at the same timesteps so that stacked areas remain consistent: the result is the
+    union of the points selected for each column, i.e. at most ncols * max_points rows.
+
     Parameters:
-        demand (pd.Series): demand production
-        pv (pd.Series): pv production
-        E (dict):  Energy flows. Dictionary of pd.Series: res_pv, grid2load, store2inv, LevelOfCharge
+        df (pd.DataFrame): time series, one per column
+        max_points (int): number of points per column (e.g. the width of the axes in pixels)
+        method (str): 'minmax' (keeps the min and max of each bucket) or 'lttb' (Largest-Triangle-Three-Buckets)
+    Returns:
+        pd.DataFrame: downsampled copy of df (df itself if it is already small enough)
     """
+    n = len(df)
+    if max_points is None or n <= max_points or max_points < 3:
+        return df
+    values = df.to_numpy(dtype=float)
+    if method == 'minmax':
+        idx = _minmax_indices(values, max_points)
+    elif method == 'lttb':
+        idx = np.unique(np.concatenate([_lttb_indices(values[:, j], max_points) for j in range(values.shape[1])]))
+    else:
+        raise ValueError("Unknown downsampling method '{}'. Use 'minmax' or 'lttb'".format(method))
+    return df.iloc[idx]
 
-    sliced_index = (pv.index.isocalendar().week==week)
-    pv_sliced = pv[sliced_index]
-    demand_sliced = demand[sliced_index]
-    self_consumption = E['inv2load'][sliced_index]
-    res_pv_sliced = E['res_pv'][sliced_index]
-    grid2load_sliced = E['grid2load'][sliced_index]
-    store2inv_sliced = E['store2inv'][sliced_index]
-    LevelOfCharge = E['LevelOfCharge'][sliced_index]
-    inv2grid = E['inv2grid'][sliced_index]
-    grid2load = E['grid2load'][sliced_index]
 
+def _max_points(fig, max_points):
+    if max_points == 'auto':
+        return int(fig.get_figwidth() * fig.dpi)
+    return max_points
 
 
+def plot_dispatch(pv, demand, E, week=30, start=None, end=None, max_points='auto', method='minmax'):
+    """ Visualize dispatch algorithm for a specific week or date range
+    Parameters:
+        demand (pd.Series): demand production
+        pv (pd.Series): pv production
+        E (dict):  Energy flows. Dictionary of pd.Series or ndarrays: res_pv, grid2load, store2inv, LevelOfCharge
+        week (int): ISO week number to plot (ignored if start or end are provided)
+        start, end (str or datetime): boundaries of the date range to plot (inclusive)
+        max_points (int, 'auto' or None): number of points kept for drawing. 'auto' uses the figure width in pixels,
+                None disables downsampling
+        method (str): downsampling method, 'minmax' or 'lttb'
+    Returns:
+        tuple: matplotlib Figure and array of the three Axes
+    """
+    # Slice before assembling the frame so that only the plotted period is copied
+    sel = _select_period(pv.index, week, start, end)
+    flows = ['inv2load', 'res_pv', 'grid2load', 'store2inv', 'LevelOfCharge', 'inv2grid']
+    df = pd.DataFrame({k: np.asarray(E[k])[sel] for k in flows}, index=pv.index[sel])
+    df['pv'] = np.asarray(pv)[sel]
+    df['demand'] = np.asarray(demand)[sel]
+
     fig, axes = plt.subplots(nrows=3, ncols=1, sharex=True, figsize=(17, 4*3), frameon=False,
                              gridspec_kw={'height_ratios': [3, 1, 1], 'hspace': 0.04})
+    df = downsample(df, _max_points(fig, max_points), method)
+    t = df.index
+    pv_sliced = df['pv']
+    self_consumption = df['inv2load']
+    store2inv = df['store2inv']
+    grid2load = df['grid2load']
 
-    #fig, ax = plt.subplots(figsize=(17, 4))
-    axes[0].plot(demand_sliced.index, demand_sliced, color='black', lw=2)
-    axes[0].fill_between(self_consumption.index, 0, self_consumption, color='orange', alpha=.2)
-    axes[0].fill_between(res_pv_sliced.index, self_consumption, pv_sliced , color='yellow', alpha=.2)
-    axes[0].fill_between(store2inv_sliced.index,
+    axes[0].plot(t, df['demand'], color='black', lw=2)
+    axes[0].fill_between(t, 0, self_consumption, color='orange', alpha=.2)
+    axes[0].fill_between(t, self_consumption, pv_sliced, color='yellow', alpha=.2)
+    axes[0].fill_between(t,
                     pv_sliced,
-                    store2inv_sliced + pv_sliced, color='blue',alpha=.2, hatch='//')
-    axes[0].fill_between(grid2load_sliced.index,
-                    pv_sliced + store2inv_sliced,
-                    grid2load_sliced + pv_sliced + store2inv_sliced, color='grey', alpha=.2)
-    axes[0].plot(grid2load_sliced.index, grid2load_sliced, color='red', ls=":", lw=1)
+                    store2inv + pv_sliced, color='blue', alpha=.2, hatch='//')
+    axes[0].fill_between(t,
+                    pv_sliced + store2inv,
+                    grid2load + pv_sliced + store2inv, color='grey', alpha=.2)
+    axes[0].plot(t, grid2load, color='red', ls=":", lw=1)
     axes[0].set_ylim([0, axes[0].get_ylim()[1] ])
     axes[0].set_ylabel('Power (kW)')
 
-    axes[1].fill_between(LevelOfCharge.index, 0, LevelOfCharge, color='grey', alpha=.2)
+    axes[1].fill_between(t, 0, df['LevelOfCharge'], color='grey', alpha=.2)
     axes[1].set_ylabel('State of Charge (kWh)')
 
-    axes[2].fill_between(inv2grid.index, 0, inv2grid, color='green', alpha=.2)
-    axes[2].fill_between(inv2grid.index, 0, -grid2load, color='red', alpha=.2)
-    axes[2].set_ylabel('In/out from grid (kWh)')
+    axes[2].fill_between(t, 0, df['inv2grid'], color='green', alpha=.2)
+    axes[2].fill_between(t, 0, -grid2load, color='red', alpha=.2)
+    axes[2].set_ylabel('In/out from grid (kW)')
+
+    return fig, axes
+
+
+def plot_fleet(index, E, percentiles=(5, 25, 50, 75, 95), start=None, end=None, max_points='auto', method='minmax'):
+    """ Visualize the dispatch of a fleet of households as percentile bands of the state of charge
+    and of the grid exchange (export minus import).
+    Parameters:
+        index (pd.DatetimeIndex): time index shared by all households
+        E (dict): Energy flows of the fleet. Dictionary of 2D arrays (or DataFrames) of shape (Nsteps, Nhouseholds)
+                with at least LevelOfCharge, inv2grid and grid2load
+        percentiles (sequence): percentiles to compute, symmetric pairs are drawn as bands and the middle one as a line
+        start, end (str or datetime): boundaries of the date range to plot (inclusive)
+        max_points (int, 'auto' or None): number of points kept for drawing. 'auto' uses the figure width in pixels,
+                None disables downsampling
+        method (str): downsampling method, 'minmax' or 'lttb'
+    Returns:
+        tuple: matplotlib Figure and array of the two Axes
+    """
+    index = pd.DatetimeIndex(index)
+    sel = _select_period(index, start=start, end=end)
+    percentiles = sorted(percentiles)
+    soc = np.asarray(E['LevelOfCharge'])[sel]
+    grid = np.asarray(E['inv2grid'])[sel] - np.asarray(E['grid2load'])[sel]
+    t = index[sel]
+    bands = {'LevelOfCharge': fleet_percentiles(soc, percentiles),
+             'grid': fleet_percentiles(grid, percentiles)}
 
-    return
+    fig, axes = plt.subplots(nrows=2, ncols=1, sharex=True, figsize=(17, 4*2), frameon=False,
+                             gridspec_kw={'hspace': 0.04})
+    n_points = _max_points(fig, max_points)
+    for ax, (key, color, label) in zip(axes, [('LevelOfCharge', 'grey', 'State of Charge (kWh)'),
+                                              ('grid', 'green', 'In/out from grid (kW)')]):
+        df = downsample(pd.DataFrame(bands[key], index=t), n_points, method)
+        n_bands = len(percentiles) // 2
+        for i in range(n_bands):
+            ax.fill_between(df.index, df.iloc[:, i], df.iloc[:, -1 - i], color=color, alpha=.15 + .15 * i / max(n_bands, 1),
+                            lw=0, label='P{:g}-P{:g}'.format(percentiles[i], percentiles[-1 - i]))
+        if len(percentiles) % 2:
+            ax.plot(df.index, df.iloc[:, n_bands], color='black', lw=1, label='P{:g}'.format(percentiles[n_bands]))
+        ax.set_ylabel(label)
+    axes[0].set_ylim([0, axes[0].get_ylim()[1]])
+    axes[1].axhline(0, color='black', lw=.5)
+    axes[0].legend(loc='upper right')
 
+    return fig, axes
@@ -0,0 +1,128 @@
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+from prosumpy import plot_dispatch, plot_fleet, downsample, fleet_percentiles
+from prosumpy import plot
+import numpy as np
+import pandas as pd
+
+import pytest
+
+@pytest.fixture(scope="module")
+def minute_data():
+    index = pd.date_range('2015-01-01', periods=60*24*60, freq='1min')
+    rng = np.random.default_rng(0)
+    pv = pd.Series(np.maximum(np.sin(np.arange(len(index)) * 2 * np.pi / 1440), 0) * 5, index=index)
+    demand = pd.Series(rng.uniform(0, 3, len(index)), index=index)
+    E = {k: rng.uniform(0, 2, len(index)) for k in ['inv2load', 'res_pv', 'grid2load', 'store2inv', 'LevelOfCharge', 'inv2grid']}
+    return pv, demand, E
+
+def test_downsample_minmax_keeps_envelope():
+    df = pd.DataFrame(np.random.default_rng(1).normal(size=(10000, 3)))
+    out = downsample(df, 300, method='minmax')
+    assert 300 <= len(out) <= 3 * 300 + 2
+    assert np.allclose(out.max(), df.max())
+    assert np.allclose(out.min(), df.min())
+    assert out.index.is_monotonic_increasing
+
+def test_downsample_keeps_pixel_density_per_column():
+    # A diurnal curve next to smooth columns must still be drawn at the full pixel width
+    n = 31 * 1440
+    t = np.arange(n)
+    df = pd.DataFrame({'pv': np.maximum(np.sin(t * 2 * np.pi / 1440), 0)})
+    for j in range(7):
+        df['c{}'.format(j)] = t / n + j
+    out = downsample(df, 1700)
+    assert len(out) >= 1700
+    # min and max of every column are kept within each pixel-wide bucket
+    edges = np.linspace(0, n, 1700 // 2 + 1).astype(int)
+    kept = out['pv'].groupby(np.searchsorted(edges, out.index, side='right')).agg(['min', 'max'])
+    ref = df['pv'].groupby(np.searchsorted(edges, df.index, side='right')).agg(['min', 'max'])
+    assert np.allclose(kept.values, ref.values)
+
+@pytest.mark.parametrize('method', ['minmax', 'lttb'])
+def test_downsample_sparse_nans(method):
+    rng = np.random.default_rng(4)
+    df = pd.DataFrame({'a': rng.normal(size=100000), 'b': np.sin(np.linspace(0, 50, 100000))})
+    df.iloc[500::1000] = np.nan
+    out = downsample(df, 900, method=method)
+    assert out.isna().any(axis=1).sum() == 0
+    if method == 'minmax':
+        assert np.allclose(out.max(), df.max())
+        assert np.allclose(out.min(), df.min())
+
+def test_downsample_keeps_nan_gaps():
+    y = np.arange(10000.)
+    y[4000:6000] = np.nan
+    for method in ['minmax', 'lttb']:
+        out = downsample(pd.DataFrame({'a': y}), 100, method=method)
+        assert out['a'].isna().any()
+        assert np.isclose(out['a'].max(), 9999) and np.isclose(out['a'].min(), 0)
+
+def test_downsample_lttb():
+    df = pd.DataFrame({'a': np.sin(np.linspace(0, 20, 5000))})
+    out = downsample(df, 200, method='lttb')
+    assert len(out) == 200
+    assert out.index[0] == 0 and out.index[-1] == 4999
+
+def test_downsample_small_input_unchanged():
+    df = pd.DataFrame({'a': np.arange(10.)})
+    assert downsample(df, 100) is df
+
+def test_fleet_percentiles():
+    X = np.tile(np.arange(101.), (4, 1))
+    P = fleet_percentiles(X, [0, 50, 100])
+    assert P.shape == (4, 3)
+    assert np.allclose(P, [0, 50, 100])
+
+@pytest.mark.parametrize('method', ['minmax', 'lttb'])
+def test_plot_dispatch_date_range(minute_data, method):
+    pv, demand, E = minute_data
+    fig, axes = plot_dispatch(pv, demand, E, start='2015-01-01', end='2015-01-31', method=method)
+    width = int(fig.get_figwidth() * fig.dpi)
+    x, y = axes[0].lines[0].get_data()
+    assert width <= len(x) <= 8 * width + 2
+    # The end date is inclusive and covers the whole last day
+    assert pd.Timestamp(x[-1]) == pd.Timestamp('2015-01-31 23:59')
+    if method == 'minmax':
+        sliced = demand['2015-01-01':'2015-01-31']
+        assert np.isclose(np.max(y), sliced.max()) and np.isclose(np.min(y), sliced.min())
+    plt.close(fig)
+
+def test_plot_dispatch_week(minute_data):
+    pv, demand, E = minute_data
+    fig, axes = plot_dispatch(pv, demand, E, week=2, max_points=None)
+    assert len(axes[0].lines[0].get_xdata()) == 7 * 24 * 60
+    assert axes[2].get_ylabel() == 'In/out from grid (kW)'
+    plt.close(fig)
+
+def test_select_period_unsorted_matches_sorted():
+    index = pd.date_range('2015-01-01', periods=5 * 1440, freq='1min')
+    shuffled = index[np.random.default_rng(3).permutation(len(index))]
+    expected = index[index.slice_indexer('2015-01-02', '2015-01-03')]
+    sel = plot._select_period(shuffled, start='2015-01-02', end='2015-01-03')
+    assert shuffled[sel].sort_values().equals(expected)
+    assert shuffled[sel].max() == pd.Timestamp('2015-01-03 23:59')
+
+def test_iso_weeks_built_once(minute_data, monkeypatch):
+    pv, demand, E = minute_data
+    calls = []
+    isocalendar = pd.DatetimeIndex.isocalendar
+    def counting_isocalendar(self):
+        calls.append(1)
+        return isocalendar(self)
+    monkeypatch.setattr(pd.DatetimeIndex, 'isocalendar', counting_isocalendar)
+    monkeypatch.setattr(plot, '_ISO_WEEKS', {})
+    for week in [2, 3, 4]:
+        fig, axes = plot_dispatch(pv, demand, E, week=week)
+        plt.close(fig)
+    assert len(calls) == 1
+
+def test_plot_fleet(minute_data):
+    pv, demand, E = minute_data
+    rng = np.random.default_rng(2)
+    fleet = {k: rng.uniform(0, 2, (len(pv), 20)) for k in ['LevelOfCharge', 'inv2grid', 'grid2load']}
+    fig, axes = plot_fleet(pv.index, fleet, start='2015-01-01', end='2015-01-07')
+    assert len(axes[0].collections) == 2
+    assert len(axes[0].lines) == 1
+    plt.close(fig)